@@ -1,6 +1,12 @@
 import os
+import sys
 import argparse
 import json
+import multiprocessing
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 import tree_sitter_python as tspython
 from tree_sitter import Language, Parser, Query, QueryCursor
 
@@ -8,6 +14,10 @@ from tree_sitter import Language, Parser, Query, QueryCursor
 PY_LANGUAGE = Language(tspython.language())
 parser = Parser(PY_LANGUAGE)
 
+# Numeric node kinds, so the structure walk compares ints instead of type strings
+CLASS_DEF_ID = PY_LANGUAGE.id_for_node_kind('class_definition', True)
+FUNC_DEF_ID = PY_LANGUAGE.id_for_node_kind('function_definition', True)
+
 # Built-in Python functions to exclude from call tracking
 PYTHON_BUILTINS = {
     'abs', 'all', 'any', 'ascii', 'bin', 'bool', 'breakpoint', 'bytearray',
@@ -21,6 +31,70 @@ PYTHON_BUILTINS = {
     'setattr', 'slice', 'sorted', 'staticmethod', 'str', 'sum', 'super',
     'tuple', 'type', 'vars', 'zip', '__import__'
 }
+# Byte-string copy so calls can be filtered on the raw source slice before decoding
+PYTHON_BUILTINS_B = frozenset(name.encode('ascii') for name in PYTHON_BUILTINS)
+
+# Logging/warning calls carry no architectural meaning; dropping them here keeps
+# them out of the LLM prompt instead of asking the model to ignore them
+NOISE_CALL_PREFIXES_B = (
+    b'logging.', b'logger.', b'_logger.', b'log.', b'self.logger.', b'self.log.',
+    b'warnings.',
+)
+
+# Directories never worth scanning for project source: vendored packages and
+# bytecode hold third-party or generated code that can dwarf the repo itself.
+# Hidden directories (.git, .venv, .tox, ...) are skipped as well.
+SKIP_DIRS = {'__pycache__', 'node_modules', 'site-packages'}
+
+# Conventional virtualenv and build output names, skipped only at the repository
+# root: deeper down they are often real packages (src/build/, operations/build/).
+# Virtualenvs elsewhere are recognised by their pyvenv.cfg instead.
+ROOT_SKIP_DIRS = {'venv', 'env', 'dist', 'build'}
+
+# Below this many files per worker, process startup costs more than parsing saves
+MIN_FILES_PER_WORKER = 8
+
+# Workers are never forked from the caller: the server scans from a worker thread
+# of a multi-threaded process, and forking one of those can deadlock the child
+POOL_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+# Analyses of already-scanned files keyed by (real path, size, mtime), so
+# re-scanning an unchanged repository skips parsing; evicted least-recently-used.
+# The cache is shared by every repository scanned, hence the absolute path.
+# A stat is enough to detect edits (git rewrites every file a checkout changes)
+# and, unlike a content digest, costs no read ahead of the parallel parse.
+ANALYSIS_CACHE_SIZE = 4096
+_analysis_cache = OrderedDict()
+_analysis_cache_lock = threading.Lock()
+
+# Imports and calls share one multi-pattern query, compiled once at import time,
+# so every file's tree is traversed a single time
+ARCH_SCM = """
+(import_statement
+  name: (dotted_name) @import_name)
+(import_from_statement
+  module_name: (dotted_name) @from_import)
+(call
+  function: (_) @called_func)
+"""
+ARCH_QUERY = Query(PY_LANGUAGE, ARCH_SCM)
+IMPORT_PIDX, FROM_IMPORT_PIDX, CALL_PIDX = range(3)
+
+# Cap on in-progress matches per cursor. Without it tree-sitter's cursor can go
+# quadratic on deeply nested expressions (long call chains, nested comprehensions);
+# the tradeoff is that matches beyond the cap in such pathological spots are dropped.
+# No max start depth is set since calls are tracked at any nesting level.
+QUERY_MATCH_LIMIT = 256
+
+# Query cursors are reusable across files but not safe to share between threads
+_cursors = threading.local()
+
+def get_arch_cursor():
+    """Return this thread's long-lived cursor for ARCH_QUERY, creating it on first use."""
+    cursor = getattr(_cursors, 'arch', None)
+    if cursor is None:
+        cursor = _cursors.arch = QueryCursor(ARCH_QUERY, match_limit=QUERY_MATCH_LIMIT)
+    return cursor
 
 def get_node_text(node, source_bytes):
     """Helper to extract string from node range."""
@@ -28,91 +102,176 @@ def get_node_text(node, source_bytes):
         return ""
     return source_bytes[node.start_byte:node.end_byte].decode('utf8')
 
-def extract_calls(block_node, source_bytes):
-    """Extract function call strings from a block node."""
-    calls = []
-    call_scm = """
-    (call
-      function: (_) @called_func)
-    """
-    call_query = Query(PY_LANGUAGE, call_scm)
-    cursor = QueryCursor(call_query)
-    captures = cursor.captures(block_node)
-    for name, nodes in captures.items():
-        for node in nodes:
-            call_text = get_node_text(node, source_bytes)
-            func_name = call_text.split('.')[0].split('(')[0]
-            if func_name not in PYTHON_BUILTINS:
-                calls.append(call_text)
-    return list(set(calls))
-
-def parse_architecture(source_code, filename="unknown"):
+def get_node_name(node, source_bytes):
+    """Like get_node_text, but interned since identifiers recur across files."""
+    return sys.intern(get_node_text(node, source_bytes))
+
+def extract_calls(block_node, call_nodes, call_starts, source_bytes):
+    """Extract function call strings from the file's call nodes inside a block node."""
+    # Ordered dedup on the raw bytes: each distinct call is checked once, and only
+    # calls that survive the builtin/noise filters are ever decoded
+    calls = {}
+    lo = bisect_left(call_starts, block_node.start_byte)
+    hi = bisect_left(call_starts, block_node.end_byte, lo)
+    for node in call_nodes[lo:hi]:
+        call_bytes = source_bytes[node.start_byte:node.end_byte]
+        if call_bytes not in calls:
+            func_name = call_bytes.split(b'.', 1)[0].split(b'(', 1)[0]
+            calls[call_bytes] = (
+                func_name not in PYTHON_BUILTINS_B
+                and not call_bytes.startswith(NOISE_CALL_PREFIXES_B)
+            )
+    return [sys.intern(call_bytes.decode('utf8')) for call_bytes, keep in calls.items() if keep]
+
+def parse_architecture(source_bytes, filename="unknown"):
     global parser, PY_LANGUAGE
-    tree = parser.parse(bytes(source_code, "utf8"))
-    source_bytes = bytes(source_code, "utf8")
+    if isinstance(source_bytes, str):
+        source_bytes = source_bytes.encode('utf8')
+    tree = parser.parse(source_bytes)
 
     # ---------------------------------------------------------
-    # QUERY 1: IMPORTS
+    # QUERY: IMPORTS & CALLS (single pass over the tree)
     # ---------------------------------------------------------
-    import_scm = """
-    (import_statement
-      name: (dotted_name) @import_name)
-    (import_from_statement
-      module_name: (dotted_name) @from_import)
-    """
-    import_query = Query(PY_LANGUAGE, import_scm)
-    imports = []
-    cursor = QueryCursor(import_query)
-    for name, nodes in cursor.captures(tree.root_node).items():
-        for node in nodes:
-            imports.append(get_node_text(node, source_bytes))
+    cursor = get_arch_cursor()
+    imports = {}
+    call_nodes = []
+    for pattern_index, captures in cursor.matches(tree.root_node):
+        if pattern_index == CALL_PIDX:
+            call_nodes.append(captures['called_func'][0])
+        elif pattern_index == IMPORT_PIDX:
+            imports[get_node_name(captures['import_name'][0], source_bytes)] = None
+        elif pattern_index == FROM_IMPORT_PIDX:
+            imports[get_node_name(captures['from_import'][0], source_bytes)] = None
+    # Sort call nodes by position so each body's calls can be sliced out by bisection
+    call_nodes.sort(key=lambda node: node.start_byte)
+    call_starts = [node.start_byte for node in call_nodes]
 
     # ---------------------------------------------------------
-    # QUERY 2: CLASSES & FUNCTIONS
+    # CLASSES & FUNCTIONS
     # ---------------------------------------------------------
     structures = []
     for child in tree.root_node.children:
-        if child.type == 'class_definition':
-            class_name = get_node_text(child.child_by_field_name('name'), source_bytes)
+        if child.kind_id == CLASS_DEF_ID:
+            class_name = get_node_name(child.child_by_field_name('name'), source_bytes)
             methods = []
             body = child.child_by_field_name('body')
             if body:
                 for item in body.children:
-                    if item.type == 'function_definition':
-                        method_name = get_node_text(item.child_by_field_name('name'), source_bytes)
+                    if item.kind_id == FUNC_DEF_ID:
+                        method_name = get_node_name(item.child_by_field_name('name'), source_bytes)
                         func_body = item.child_by_field_name('body')
-                        calls = extract_calls(func_body, source_bytes) if func_body else []
+                        calls = extract_calls(func_body, call_nodes, call_starts, source_bytes) if func_body else []
                         methods.append({"name": method_name, "calls": calls})
             structures.append({"type": "class", "name": class_name, "methods": methods})
-        elif child.type == 'function_definition':
-            func_name = get_node_text(child.child_by_field_name('name'), source_bytes)
+        elif child.kind_id == FUNC_DEF_ID:
+            func_name = get_node_name(child.child_by_field_name('name'), source_bytes)
             func_body = child.child_by_field_name('body')
-            calls = extract_calls(func_body, source_bytes) if func_body else []
+            calls = extract_calls(func_body, call_nodes, call_starts, source_bytes) if func_body else []
             structures.append({"type": "function", "name": func_name, "calls": calls})
-    return {"filename": filename, "imports": list(set(imports)), "structures": structures}
+    return {"filename": filename, "imports": list(imports), "structures": structures}
 
 def process_file(file_info):
     """Process a single file and return its architecture analysis."""
     full_path, rel_path = file_info
     try:
-        with open(full_path, "r", encoding="utf-8") as f:
-            source_code = f.read()
-        return parse_architecture(source_code, rel_path)
+        # Tree-sitter works on bytes, so skip the decode/re-encode round trip
+        with open(full_path, "rb") as f:
+            source_bytes = f.read()
+        return parse_architecture(source_bytes, rel_path)
     except Exception as e:
         return {"filename": rel_path, "error": str(e)}
 
+def iter_python_files(path, is_root=True):
+    """Recursively yield paths of .py files under path, skipping hidden dirs,
+    SKIP_DIRS, ROOT_SKIP_DIRS at the top level and virtualenvs.
+
+    Uses os.scandir so file/dir checks reuse the directory entry type instead of
+    issuing an extra stat per entry, as os.walk does.
+    """
+    try:
+        entries = os.scandir(path)
+    except OSError:
+        # Match os.walk, which silently skips unreadable or missing directories
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if (
+                    not entry.name.startswith('.')
+                    and entry.name not in SKIP_DIRS
+                    and not (is_root and entry.name in ROOT_SKIP_DIRS)
+                    and not os.path.exists(os.path.join(entry.path, 'pyvenv.cfg'))
+                ):
+                    yield from iter_python_files(entry.path, is_root=False)
+            elif entry.name.endswith('.py') and entry.is_file():
+                yield entry.path
+
+def analysis_cache_key(file_info):
+    """Return the (realpath, size, mtime_ns) cache key for a file, or None if unreadable."""
+    full_path, _ = file_info
+    real_path = os.path.realpath(full_path)
+    try:
+        st = os.stat(real_path)
+    except OSError:
+        return None
+    return real_path, st.st_size, st.st_mtime_ns
+
 def scan_repository(repo_path):
-    """Scan a repository sequentially and return analysis for all .py files."""
-    file_list = []
-    for root, _, files in os.walk(repo_path):
-        for file in files:
-            if file.endswith('.py'):
-                full_path = os.path.join(root, file)
-                rel_path = os.path.relpath(full_path, repo_path)
-                file_list.append((full_path, rel_path))
+    """Scan a repository and return analysis for all .py files.
+
+    Files whose content is unchanged since an earlier scan are served from the
+    analysis cache; the rest are parsed, in parallel when there are enough.
+    """
+    file_list = [
+        (full_path, os.path.relpath(full_path, repo_path))
+        for full_path in iter_python_files(repo_path)
+    ]
+    keys = [analysis_cache_key(file_info) for file_info in file_list]
+    analyses = {}
+    stale = []
+    with _analysis_cache_lock:
+        for file_info, key in zip(file_list, keys):
+            if key in _analysis_cache:
+                _analysis_cache.move_to_end(key)
+                result = _analysis_cache[key]
+                # The same file may be reached from another scan root or symlink
+                rel_path = file_info[1]
+                if result["filename"] != rel_path:
+                    result = dict(result, filename=rel_path)
+                analyses[file_info] = result
+            else:
+                stale.append((file_info, key))
+
+    parsed = parse_files([file_info for file_info, _ in stale])
+    with _analysis_cache_lock:
+        for (file_info, key), result in zip(stale, parsed):
+            analyses[file_info] = result
+            if key is not None and "error" not in result:
+                _analysis_cache[key] = result
+                if len(_analysis_cache) > ANALYSIS_CACHE_SIZE:
+                    _analysis_cache.popitem(last=False)
+    return collect_results(analyses[file_info] for file_info in file_list)
+
+def parse_files(file_list):
+    """Parse files into a list of analyses, in parallel when there are enough."""
+    n_workers = min(os.cpu_count() or 1, len(file_list) // MIN_FILES_PER_WORKER)
+    if n_workers <= 1:
+        # Too few files (or cores) for worker startup to pay off
+        return list(map(process_file, file_list))
+
+    # Workers read and parse files themselves, so only path tuples and result
+    # dicts cross the process boundary (tree-sitter trees are not picklable).
+    # Files are handed out in batches so per-task pickling and scheduling
+    # overhead is amortized; small files are otherwise dominated by IPC.
+    chunksize = max(1, len(file_list) // (4 * n_workers))
+    mp_context = multiprocessing.get_context(POOL_START_METHOD)
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context) as executor:
+        return list(executor.map(process_file, file_list, chunksize=chunksize))
+
+def collect_results(analyses):
+    """Gather successful file analyses, reporting the ones that failed."""
     results = []
-    for file_info in file_list:
-        result = process_file(file_info)
+    for result in analyses:
         if "error" in result:
             print(f"Error processing {result['filename']}: {result['error']}")
         else:
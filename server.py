@@ -1,6 +1,17 @@
+import asyncio
+import fcntl
+import functools
+import hashlib
+import io
+import itertools
 import json
 import os
-from typing import List
+import random
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
 
 import graphviz
 from dotenv import load_dotenv
@@ -9,16 +20,51 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 from git import Repo
+from git.exc import InvalidGitRepositoryError, NoSuchPathError
 from google import genai
-from google.genai import types
-from pydantic import BaseModel, Field
+from google.genai import errors, types
+from pydantic import BaseModel, Field, ValidationError
 
 from helper import extract_repo_knowledge
 
 load_dotenv()
 
 
-RELATIONSHIPS = None
+# Last PNG rendered to each output path, so follow-up requests can use it
+# without reading the image back from disk; evicted least-recently-used, since
+# every analyzed commit gets its own path
+RENDERED_DIAGRAMS_SIZE = 32
+RENDERED_DIAGRAMS = OrderedDict()
+_rendered_diagrams_lock = threading.Lock()
+
+# Upper bound on Gemini requests in flight at once, to respect rate limits
+MAX_CONCURRENT_BATCHES = 8
+
+# Per-batch LLM results are cached on disk, keyed by a hash of the batch content
+LLM_CACHE_DIR = ".llm_cache"
+
+SHALLOW_CLONE_OPTIONS = ["--depth=1", "--filter=blob:none", "--single-branch"]
+
+# Whole-repository graphs are cached on disk, keyed by the analyzed commit SHA
+GRAPH_CACHE_DIR = ".graph_cache"
+
+# Rendered diagrams of git repositories, one set of images per commit
+DIAGRAMS_DIR = "static/diagrams"
+
+# Lock files serializing clone/update/scan of each checkout, across threads and
+# worker processes alike
+REPO_LOCK_DIR = ".repo_locks"
+
+# Filling the relationship schema is mechanical, so a fast model with thinking
+# disabled handles it; the pro model is only used when its reply doesn't validate
+RELATIONSHIPS_MODEL = "gemini-2.5-flash"
+FALLBACK_RELATIONSHIPS_MODEL = "gemini-3-pro-preview"
+
+# Transient Gemini failures (5xx, 429) are retried with jittered exponential
+# backoff before a batch is given up on
+MAX_BATCH_ATTEMPTS = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 10.0
 
 class Relationship(BaseModel):
     source: str = Field(
@@ -42,72 +88,357 @@ class KnowledgeGraph(BaseModel):
 
 
 # --- 2. Core Logic ---
-def find_relationships(knowledge: list) -> KnowledgeGraph:
+SYSTEM_PROMPT = """
+You are an Expert Software Architect. Your goal is to output a FLAT list of dependencies based on the provided code structure.
+
+RULES:
+1. Output strict and correct JSON matching the KnowledgeGraph response schema.
+2. Flatten all nested calls into direct Source -> Target relationships.
+3. Normalize names: 'stripe.Charge.create' becomes 'StripeAPI'.
+4. Ignore trivial logs/prints.
+"""
+
+# Shared by every batch request instead of being rebuilt per call
+RELATIONSHIPS_CONFIG = types.GenerateContentConfig(
+    system_instruction=SYSTEM_PROMPT,
+    response_mime_type="application/json",
+    response_schema=KnowledgeGraph,
+    thinkingConfig={
+        "includeThoughts": False,
+        "thinkingBudget": 0,
+    },
+)
+FALLBACK_RELATIONSHIPS_CONFIG = RELATIONSHIPS_CONFIG.model_copy(
+    update={"thinking_config": types.ThinkingConfig(include_thoughts=False, thinking_level="LOW")}
+)
+
+
+@functools.lru_cache(maxsize=None)
+def get_client() -> genai.Client:
     """
-    Extracts dependencies using Gemini with Strict Structured Output.
+    Returns the process-wide Gemini client, created on first use so a missing
+    API key only fails the request. Reusing it keeps HTTP connections alive.
     """
+    return genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
 
-    system_prompt = """
-    You are an Expert Software Architect. Your goal is to output a FLAT list of dependencies based on the provided code structure.
 
-    RULES:
-    1. Output strict and correct JSON matching the KnowledgeGraph response schema.
-    2. Flatten all nested calls into direct Source -> Target relationships.
-    3. Normalize names: 'stripe.Charge.create' becomes 'StripeAPI'.
-    4. Ignore trivial logs/prints.
+def write_atomic(path: str, data: bytes):
     """
+    Writes data to path via a temp file + rename, so readers never see a partial file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def get_rendered_diagram(path: str) -> Optional[bytes]:
+    """
+    Returns the PNG last rendered to path by this process, or None if it was evicted.
+    """
+    with _rendered_diagrams_lock:
+        png_bytes = RENDERED_DIAGRAMS.get(path)
+        if png_bytes is not None:
+            RENDERED_DIAGRAMS.move_to_end(path)
+        return png_bytes
+
+
+def remember_rendered_diagram(path: str, png_bytes: bytes):
+    with _rendered_diagrams_lock:
+        RENDERED_DIAGRAMS[path] = png_bytes
+        RENDERED_DIAGRAMS.move_to_end(path)
+        if len(RENDERED_DIAGRAMS) > RENDERED_DIAGRAMS_SIZE:
+            RENDERED_DIAGRAMS.popitem(last=False)
+
+
+def batch_cache_path(batch: list) -> str:
+    """
+    Returns the cache file for a batch, addressed by a hash of everything that
+    shapes the answer: model, system prompt and the batch itself.
+    """
+    key = json.dumps([RELATIONSHIPS_MODEL, SYSTEM_PROMPT, batch], sort_keys=True)
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(LLM_CACHE_DIR, f"{digest}.json")
+
+
+def graph_cache_path(commit_sha: str) -> str:
+    """
+    Returns the cache file for a commit's graph. Like batch_cache_path, the key
+    covers the model and system prompt, so changing either re-analyzes commits.
+    """
+    key = json.dumps([RELATIONSHIPS_MODEL, SYSTEM_PROMPT, commit_sha])
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    return os.path.join(GRAPH_CACHE_DIR, f"{digest}.json")
+
+
+def diagram_filename(commit_sha: Optional[str]) -> str:
+    """
+    Returns the diagram output path (without extension) for a commit. Each commit
+    gets its own file so concurrent requests for different repositories don't
+    overwrite each other's image; non-git sources share the legacy path.
+    """
+    if commit_sha is None:
+        return "static/gem_3_arch"
+    return os.path.join(DIAGRAMS_DIR, commit_sha)
+
+
+def update_repo(repo_dir: str):
+    """
+    Moves an existing shallow clone to its remote's latest commit. Only what the
+    update changed is re-analyzed: unchanged files hit the parse cache and
+    unchanged batches hit the per-batch LLM cache.
+
+    The reset rewrites the working tree, so callers must hold lock_repo for
+    repo_dir: a scan or commit lookup running meanwhile would mix two commits.
+    """
+    try:
+        repo = Repo(repo_dir)
+    except InvalidGitRepositoryError:
+        # Not one of our clones; leave it as it is
+        return
+    old_sha = repo.head.commit.hexsha
+    repo.git.fetch("--depth=1", "origin")
+    repo.git.reset("--hard", "FETCH_HEAD")
+    if repo.head.commit.hexsha != old_sha:
+        print(f"Repository {repo_dir} updated to {repo.head.commit.hexsha}")
+
+
+def lock_repo(repo_dir: str):
+    """
+    Blocks until this caller holds the exclusive lock on repo_dir and returns the
+    open lock file; closing it releases the lock. flock locks belong to the open
+    file, so they exclude other threads of this process as well as other workers.
+    """
+    os.makedirs(REPO_LOCK_DIR, exist_ok=True)
+    lock_file = open(os.path.join(REPO_LOCK_DIR, f"{repo_dir}.lock"), "w")
+    fcntl.flock(lock_file, fcntl.LOCK_EX)
+    return lock_file
+
+
+def prepare_repository(git_url: str, repo_dir: str):
+    """
+    Clones or updates repo_dir, then returns (commit_sha, cached graph or None,
+    scanned knowledge or None). Runs as one blocking call under lock_repo: the
+    checkout must not change between cloning/updating it, reading its commit and
+    scanning it, or a concurrent request could scan a half-cloned tree or cache a
+    graph under the wrong commit. Keeping every step in the thread that holds the
+    lock means lock waiters can't starve the holder of executor threads.
+    """
+    with lock_repo(repo_dir):
+        try:
+            if not os.path.exists(repo_dir):
+                os.makedirs(repo_dir, exist_ok=True)
+                # Only the HEAD tree is analyzed, so skip history and other branches
+                Repo.clone_from(git_url, repo_dir, multi_options=SHALLOW_CLONE_OPTIONS)
+                print(f"Repository successfully cloned to {repo_dir}")
+            else:
+                update_repo(repo_dir)
+        except Exception as e:
+            print(f"Error cloning/updating repository: {e}")
+
+        # A commit that was already analyzed is served from the graph cache
+        commit_sha = get_commit_sha(repo_dir)
+        graph_data = load_cached_graph(graph_cache_path(commit_sha)) if commit_sha else None
+
+        # 1. Get Raw Knowledge (AST/File dict)
+        raw_knowledge = extract_repo_knowledge(repo_dir) if graph_data is None else None
+    return commit_sha, graph_data, raw_knowledge
+
+
+def get_commit_sha(repo_dir: str) -> Optional[str]:
+    """
+    Returns the commit checked out in repo_dir, or None if it isn't a git repository.
+    """
+    try:
+        return Repo(repo_dir).head.commit.hexsha
+    except (InvalidGitRepositoryError, NoSuchPathError, ValueError):
+        return None
+
+
+def load_cached_graph(cache_path: str) -> Optional[KnowledgeGraph]:
+    """
+    Returns the KnowledgeGraph cached at cache_path, or None on a miss or unreadable entry.
+    """
+    try:
+        with open(cache_path, encoding="utf-8") as f:
+            return KnowledgeGraph.model_validate_json(f.read())
+    except (OSError, ValueError):
+        return None
 
-    all_relationships = []
-    batch_size = 8
 
-    # Chunk the knowledge list into batches
-    batches = [
-        knowledge[i : i + batch_size] for i in range(0, len(knowledge), batch_size)
-    ]
+def store_cached_graph(cache_path: str, graph: KnowledgeGraph):
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    write_atomic(cache_path, graph.model_dump_json().encode("utf-8"))
+
+
+def make_batches(knowledge: list, batch_size: int) -> List[list]:
+    """
+    Splits file analyses into deterministic, directory-aligned batches.
+
+    Files are ordered by path and a directory's files are never split across
+    more batches than needed, so batch contents (and their LLM cache keys)
+    don't depend on scan order, and editing one file only invalidates the batch
+    of its own directory. Small neighbouring directories are packed together.
+    """
+    ordered = sorted(knowledge, key=lambda f: (os.path.dirname(f["filename"]), f["filename"]))
+    batches = []
+    current = []
+    for _, group in itertools.groupby(ordered, key=lambda f: os.path.dirname(f["filename"])):
+        files = list(group)
+        if len(current) + len(files) > batch_size:
+            if current:
+                batches.append(current)
+                current = []
+            # Directories bigger than a batch get batches of their own
+            while len(files) > batch_size:
+                batches.append(files[:batch_size])
+                files = files[batch_size:]
+        current.extend(files)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def is_transient(error: Exception) -> bool:
+    """True for Gemini errors worth retrying: server errors and rate limits."""
+    return isinstance(error, errors.ServerError) or (
+        isinstance(error, errors.ClientError) and error.code == 429
+    )
+
+
+async def generate_with_retry(client: genai.Client, **kwargs):
+    """
+    Calls generate_content, retrying transient failures with full-jitter
+    exponential backoff. The last error is raised once attempts run out.
+    """
+    for attempt in range(MAX_BATCH_ATTEMPTS):
+        try:
+            return await client.aio.models.generate_content(**kwargs)
+        except errors.APIError as e:
+            if not is_transient(e) or attempt == MAX_BATCH_ATTEMPTS - 1:
+                raise
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+            print(f"Transient Gemini error, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+
+
+async def generate_batch_graph(client: genai.Client, contents: str) -> KnowledgeGraph:
+    """
+    Asks the fast model for a batch's relationships, retrying once on the
+    fallback model if the reply doesn't validate against the schema.
+    """
+    try:
+        response = await generate_with_retry(
+            client, model=RELATIONSHIPS_MODEL, contents=contents, config=RELATIONSHIPS_CONFIG
+        )
+        # Fallback if parsing fails but text exists
+        return response.parsed or KnowledgeGraph.model_validate_json(response.text)
+    except ValidationError as e:
+        print(f"{RELATIONSHIPS_MODEL} reply failed validation, retrying on {FALLBACK_RELATIONSHIPS_MODEL}: {e}")
+
+    response = await generate_with_retry(
+        client, model=FALLBACK_RELATIONSHIPS_MODEL, contents=contents, config=FALLBACK_RELATIONSHIPS_CONFIG
+    )
+    return response.parsed or KnowledgeGraph.model_validate_json(response.text)
+
+
+async def find_relationships(knowledge: list) -> Tuple[KnowledgeGraph, int]:
+    """
+    Extracts dependencies using Gemini with Strict Structured Output.
+
+    Returns the graph together with the number of batches that failed; a graph
+    with failed batches is missing those files' relationships.
+    """
+
+    # Files without imports or definitions (empty __init__.py, constants
+    # modules) have nothing to relate, so they only cost prompt tokens
+    knowledge = [f for f in knowledge if f["imports"] or f["structures"]]
+
+    all_relationships = []
+    batches = make_batches(knowledge, batch_size=8)
 
     print(f"Processing {len(knowledge)} files in {len(batches)} batches...")
 
+    # Outside the try: a client that can't be built (e.g. missing API key) is a
+    # configuration error for the caller to report, not an empty graph
+    client = get_client()
+
     try:
-        client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
-
-        for i, batch in enumerate(batches):
-            print(f"Calling LLM API for batch {i + 1}/{len(batches)}...")
-
-            try:
-                response = client.models.generate_content(
-                    model="gemini-3-pro-preview",
-                    # model="gemini-2.5-flash-lite-preview-09-2025",
-                    contents=f"Analyze this code structure and generate the dependency graph:\n\n{json.dumps(batch)}",
-                    config=types.GenerateContentConfig(
-                        system_instruction=system_prompt,
-                        response_mime_type="application/json",
-                        response_schema=KnowledgeGraph,
-                        thinkingConfig={
-                            "includeThoughts": False,
-                            "thinkingLevel": "LOW",
-                        },
-                    ),
-                )
-
-                if response.parsed:
-                    all_relationships.extend(response.parsed.relationships)
-                else:
-                    # Fallback if parsing fails but text exists
-                    batch_graph = KnowledgeGraph.model_validate_json(response.text)
-                    all_relationships.extend(batch_graph.relationships)
-
-            except Exception as e:
-                print(f"Error processing batch {i + 1}: {e}")
-                # Continue to next batch instead of failing completely
-                continue
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+
+        async def process_batch(i, batch):
+            cache_path = batch_cache_path(batch)
+            cached = load_cached_graph(cache_path)
+            if cached is not None:
+                return cached.relationships
+
+            async with semaphore:
+                print(f"Calling LLM API for batch {i + 1}/{len(batches)}...")
+
+                try:
+                    batch_graph = await generate_batch_graph(
+                        client,
+                        f"Analyze this code structure and generate the dependency graph:\n\n{json.dumps(batch, separators=(',', ':'))}",
+                    )
+                    store_cached_graph(cache_path, batch_graph)
+                    return batch_graph.relationships
+
+                except Exception as e:
+                    print(f"Error processing batch {i + 1}: {e}")
+                    # Skip this batch instead of failing completely
+                    return None
+
+        # Batches are independent network round-trips, so run them concurrently
+        batch_results = await asyncio.gather(
+            *(process_batch(i, batch) for i, batch in enumerate(batches))
+        )
+        failed_batches = 0
+        for relationships in batch_results:
+            if relationships is None:
+                failed_batches += 1
+            else:
+                all_relationships.extend(relationships)
 
         res = KnowledgeGraph(relationships=all_relationships)
-        return res
+        return res, failed_batches
 
     except Exception as e:
         print(f"LLM Extraction Error: {e}")
         # Return empty graph on failure to prevent API crash
-        return []
+        return KnowledgeGraph(relationships=[]), len(batches)
+
+
+# Node styling rules, checked in order (first match wins). Each keyword group is
+# one precompiled regex, so a node name is scanned in C rather than by a
+# Python-level substring test per keyword.
+NODE_STYLES = [
+    (re.compile("db|database|sql|redis", re.IGNORECASE), ("cylinder", "#FFF9C4")),  # Yellow
+    (re.compile("api|stripe|aws|s3", re.IGNORECASE), ("component", "#E1F5FE")),  # Blue
+    (re.compile("user|client|front", re.IGNORECASE), ("oval", "#F5F5F5")),  # Grey
+]
+DEFAULT_NODE_STYLE = ("box", "#E8F5E9")  # Green default
+
+# Node count from which diagrams are laid out with sfdp instead of dot
+LARGE_GRAPH_NODES = 50
+
+
+@functools.lru_cache(maxsize=4096)
+def get_style(node_name):
+    """Return the (shape, fillcolor) Graphviz style for a node name."""
+    for pattern, style in NODE_STYLES:
+        if pattern.search(node_name):
+            return style
+    return DEFAULT_NODE_STYLE
+
+
+@functools.lru_cache(maxsize=32)
+def layout_png(engine, source):
+    """
+    Lay out DOT source with Graphviz and return the PNG bytes. Memoized on the
+    source, so re-rendering an unchanged relationship set (a repeat request, or
+    a commit that didn't touch any relationships) skips the layout engine.
+    """
+    return graphviz.pipe(engine, "png", source.encode("utf-8"))
 
 
 def render_architecture_graph(
@@ -119,50 +450,51 @@ def render_architecture_graph(
 
     print("Rendering architecture graph...")
 
-    dot = graphviz.Digraph(comment="Architecture Auto-Draftsman")
+    # Extract relationships list from Pydantic model
+    edges = graph_data.relationships
+
+    # Add each distinct node once (in first-seen order), then the edges
+    nodes = dict.fromkeys(name for edge in edges for name in (edge.source, edge.target))
+
+    # Layered dot + orthogonal routing reads best but scales badly; big graphs
+    # use the multilevel force-directed sfdp engine with plain splines instead
+    if len(nodes) < LARGE_GRAPH_NODES:
+        dot = graphviz.Digraph(comment="Architecture Auto-Draftsman")
+        dot.attr(rankdir="LR", splines="ortho")
+    else:
+        dot = graphviz.Digraph(comment="Architecture Auto-Draftsman", engine="sfdp")
+        dot.attr(overlap="prism", splines="true")
 
     # Styling
-    dot.attr(rankdir="LR", splines="ortho")
     dot.attr("node", shape="box", style="filled", fontname="Helvetica")
     dot.attr("edge", fontname="Helvetica", fontsize="10", color="#455A64")
 
-    def get_style(node_name):
-        n = node_name.lower()
-        if any(x in n for x in ["db", "database", "sql", "redis"]):
-            return "cylinder", "#FFF9C4"  # Yellow
-        if any(x in n for x in ["api", "stripe", "aws", "s3"]):
-            return "component", "#E1F5FE"  # Blue
-        if any(x in n for x in ["user", "client", "front"]):
-            return "oval", "#F5F5F5"  # Grey
-        return "box", "#E8F5E9"  # Green default
-
-    # Extract relationships list from Pydantic model
-    edges = graph_data.relationships
-    added_nodes = set()
+    for node_name in nodes:
+        s, c = get_style(node_name)
+        dot.node(node_name, shape=s, fillcolor=c)
 
     for edge in edges:
-        # Add Source
-        if edge.source not in added_nodes:
-            s, c = get_style(edge.source)
-            dot.node(edge.source, shape=s, fillcolor=c)
-            added_nodes.add(edge.source)
-
-        # Add Target
-        if edge.target not in added_nodes:
-            s, c = get_style(edge.target)
-            dot.node(edge.target, shape=s, fillcolor=c)
-            added_nodes.add(edge.target)
-
-        # Add Edge
         dot.edge(edge.source, edge.target, label=edge.label)
 
     try:
-        output_path = dot.render(output_filename, format="png", view=False)
-        return output_path
+        # Pipe straight to PNG bytes rather than dot.render, which writes the
+        # DOT source to disk and has the dot binary read it back
+        png_bytes = layout_png(dot.engine, dot.source)
     except Exception as e:
         print(f"Graphviz Error: {e}")
         return None
 
+    # The same bytes object is already on disk at this path; nothing to write
+    output_path = f"{output_filename}.png"
+    if get_rendered_diagram(output_path) is png_bytes and os.path.exists(output_path):
+        return output_path
+
+    # Atomic so the static route never serves a partial image
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    write_atomic(output_path, png_bytes)
+    remember_rendered_diagram(output_path, png_bytes)
+    return output_path
+
 
 # --- 3. API Setup ---
 app = FastAPI()
@@ -194,28 +526,33 @@ async def extract_knowledge(request: KnowledgeRequest):
         git_url = request.repo_path
         repo_dir = request.repo_path.split("/")[-1][:-4]
 
-        try:
-            if not os.path.exists(repo_dir):
-                os.makedirs(repo_dir, exist_ok=True)
-                Repo.clone_from(git_url, repo_dir)
-                print(f"Repository successfully cloned to {repo_dir}")
-        except Exception as e:
-            print(f"Error cloning repository: {e}")
-
-        # 1. Get Raw Knowledge (AST/File dict)
-        raw_knowledge = extract_repo_knowledge(repo_dir)
+        # Clone/update, commit lookup and scan, all under the checkout's lock
+        commit_sha, graph_data, raw_knowledge = await asyncio.to_thread(
+            prepare_repository, git_url, repo_dir
+        )
 
-        # 2. Get Flat Relationships (Pydantic Object)
-        graph_data: KnowledgeGraph = find_relationships(raw_knowledge)
-        RELATIONSHIPS = graph_data.relationships
+        failed_batches = 0
+        if graph_data is None:
+            # 2. Get Flat Relationships (Pydantic Object)
+            graph_data, failed_batches = await find_relationships(raw_knowledge)
+            # A graph missing failed batches isn't pinned to the commit, so a retry
+            # fills them in; the batches that succeeded are served from the LLM cache
+            if commit_sha and not failed_batches:
+                store_cached_graph(graph_cache_path(commit_sha), graph_data)
 
         # 3. Generate Diagram
-        diagram_path = render_architecture_graph(graph_data)
+        diagram_path = await asyncio.to_thread(
+            render_architecture_graph, graph_data, diagram_filename(commit_sha)
+        )
 
         # 4. Return JSON
         return {
             "status": "success",
             "diagram_path": diagram_path,
+            "commit_sha": commit_sha,
+            # Non-zero means the graph is partial and wasn't cached, so it can't
+            # be enhanced; re-running the extraction retries the failed batches
+            "failed_batches": failed_batches,
         }
 
     except Exception as e:
@@ -226,12 +563,20 @@ async def extract_knowledge(request: KnowledgeRequest):
         raise HTTPException(status_code=500, detail=str(e))
 
 
+class EnhanceRequest(BaseModel):
+    commit_sha: str = Field(..., pattern="^[0-9a-f]{40}$")
+
+
 @app.post("/enhance_diagram")
-async def enhance_diagram():
+async def enhance_diagram(request: EnhanceRequest):
     from PIL import Image
 
     try:
-        client = genai.Client(api_key=os.getenv("GOOGLE_API_KEY"))
+        graph_data = load_cached_graph(graph_cache_path(request.commit_sha))
+        if graph_data is None:
+            raise HTTPException(status_code=404, detail="No knowledge graph for this commit")
+
+        client = get_client()
 
         prompt = f"""
         Generate a professional, high-fidelity technical knowledge graph diagram.
@@ -244,37 +589,47 @@ async def enhance_diagram():
 
         **LAYOUT & CONTENT INSTRUCTIONS:**
         Organize the elements spatially to minimize overlapping lines. The flow should generally move from inputs (left/top) to data storage (right/bottom).
+        The attached image is the current draft of this diagram; keep every node and edge it shows.
 
         DETAILED CONTENT DESCRIPTION:
-        {RELATIONSHIPS}
+        {graph_data.relationships}
         """
 
         # Use absolute path or relative to CWD, assuming CWD is repo root
-        input_image_path = "static/gem_3_arch.png"
-        if not os.path.exists(input_image_path):
+        input_image_path = f"{diagram_filename(request.commit_sha)}.png"
+        png_bytes = get_rendered_diagram(input_image_path)
+        if png_bytes is None and not os.path.exists(input_image_path):
             raise HTTPException(status_code=404, detail="Original diagram not found")
 
-        image = Image.open(input_image_path)
+        # Prefer the in-memory render; fall back to disk after a server restart
+        if png_bytes is not None:
+            image = Image.open(io.BytesIO(png_bytes))
+        else:
+            image = await asyncio.to_thread(Image.open, input_image_path)
 
-        response = client.models.generate_content(
+        response = await client.aio.models.generate_content(
             model="gemini-3-pro-image-preview",
-            contents=[prompt],
+            contents=[prompt, image],
         )
 
-        output_path = "static/gem_3_arch_enhanced.png"
+        output_path = f"{diagram_filename(request.commit_sha)}_enhanced.png"
 
         for part in response.parts:
             if part.text is not None:
                 print(part.text)
             elif part.inline_data is not None:
-                image = part.as_image()
-                image.save(output_path)
+                enhanced = part.as_image()
+                await asyncio.to_thread(enhanced.save, output_path)
 
         return {
             "status": "success",
             "diagram_path": output_path
         }
 
+    except HTTPException:
+        # Deliberate client errors (e.g. 404) pass through unchanged
+        raise
+
     except Exception as e:
         import traceback
 
@@ -284,4 +639,12 @@ async def enhance_diagram():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Parsing and Graphviz are CPU-bound, so spread requests over processes.
+    # Workers share nothing in memory; the LLM, graph and diagram caches all
+    # live on disk, so any worker can serve any commit.
+    uvicorn.run(
+        "server:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=max(2, (os.cpu_count() or 1) // 2),
+    )
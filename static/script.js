@@ -6,7 +6,8 @@ document.addEventListener('DOMContentLoaded', () => {
     const errorMessage = document.getElementById('error-message');
 
     const enhanceBtn = document.getElementById('enhanceBtn');
-    let currentKnowledge = null;
+    // Commit the current diagram was generated from; enhancement looks its graph up by it
+    let currentCommitSha = null;
 
     // API Base URL - change this if your server runs on a different port
     const API_BASE_URL = 'http://localhost:8000';
@@ -41,13 +42,19 @@ document.addEventListener('DOMContentLoaded', () => {
             }
 
             const data = await response.json();
+            currentCommitSha = data.commit_sha;
 
             // Update image
             updateImage(data.diagram_path);
 
-            // Show result and enhance button
+            // Show result, and the enhance button when there is a graph to enhance.
+            // A partial graph (some batches failed) isn't cached, so it can't be.
             resultSection.classList.remove('hidden');
-            enhanceBtn.classList.remove('hidden');
+            if (data.failed_batches) {
+                showError(`${data.failed_batches} batch(es) failed; the diagram is incomplete. Run it again to retry them.`);
+            } else if (currentCommitSha) {
+                enhanceBtn.classList.remove('hidden');
+            }
 
         } catch (error) {
             console.error('Error:', error);
@@ -69,6 +76,7 @@ document.addEventListener('DOMContentLoaded', () => {
                 headers: {
                     'Content-Type': 'application/json',
                 },
+                body: JSON.stringify({ commit_sha: currentCommitSha }),
             });
 
             if (!response.ok) {